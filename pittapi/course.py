@@ -19,12 +19,18 @@ with this program; if not, write to the Free Software Foundation, Inc.,
 
 import json
 import re
+import sys
+import time
+from collections import OrderedDict
 from datetime import datetime
-from typing import List, Dict, Generator, NamedTuple, Optional, Tuple
+from functools import lru_cache
+from typing import Any, List, Dict, Generator, NamedTuple, Optional, Tuple
 
+import lxml.html
 import requests
-from requests_html import HTMLSession, HTMLResponse
+from lxml import etree
 from parse import compile
+from requests.adapters import HTTPAdapter
 
 CLASS_SEARCH_URL = "https://psmobile.pitt.edu/app/catalog/classSearch"
 CLASS_SEARCH_API_URL = "https://psmobile.pitt.edu/app/catalog/getClassSearch"
@@ -32,6 +38,19 @@ SECTION_DETAIL_URL = (
     "https://psmobile.pitt.edu/app/catalog/classsection/UPITT/{term}/{class_number}"
 )
 
+# Seconds a CSRFToken is reused for before a new one is requested
+CSRF_TOKEN_LIFETIME = 10 * 60
+# Statuses returned when the server rejects an expired CSRFToken
+CSRF_REJECTED_STATUS = {403, 419}
+# Maximum number of requests the bulk getters have in flight at once
+BULK_REQUEST_LIMIT = 16
+# Number of section detail pages kept by get_extra_section_details
+SECTION_DETAIL_CACHE_SIZE = 4096
+# Seconds a section detail page is reused for, kept short since it includes live seat counts
+SECTION_DETAIL_LIFETIME = 5 * 60
+# Bytes of a class search response read from the network per parser feed
+LISTING_CHUNK_SIZE = 32 * 1024
+
 LABEL_MAP = {
     "Session": "session",
     "Career": "career",
@@ -56,10 +75,51 @@ COMBINED_SECTION_PATTERN = compile(
     "{course_name}\n{subject_code} {course_number} - {section_number} ({class_number})\nStatus: {status}\nSeats Taken: {seats_taken:d}\nWait List Total: {wait_list_total:d}"
 )
 CREDIT_UNITS_PATTERN = compile("{:d} units")
-SECTION_INFORMATION_PATTERN = compile(
-    "Section: {section_number}-{section_type} ({class_number})\nSession: {session}\nDays/Times: {dt}\nRoom: {room}\nInstructor: {instructor}\nMeeting Dates: {meeting_dates}\nStatus: {status:w}{}"
+# Matched once per course/section on every search page, so these are plain regexes
+# rather than parse patterns to keep the per-element work inside the re engine.
+SECTION_INFORMATION_PATTERN = re.compile(
+    r"Section: (?P<section_number>.+?)-(?P<section_type>.+?) \((?P<class_number>.+?)\)\n"
+    r"Session: (?P<session>.+?)\n"
+    r"Days/Times: (?P<dt>.+?)\n"
+    r"Room: (?P<room>.+?)\n"
+    r"Instructor: (?P<instructor>.+?)\n"
+    r"(?:Meeting )?Dates: (?P<meeting_dates_raw>.+?)\n"
+    r"Status: (?P<status>\w+).*",
+    re.IGNORECASE | re.DOTALL,
+)
+COURSE_INFORMATION_PATTERN = re.compile(
+    r"(?P<subject_code>.+?) (?P<course_number>.+?) - (?P<course_title>.+?)",
+    re.IGNORECASE | re.DOTALL,
 )
-COURSE_INFORMATION_PATTERN = compile("{subject_code} {course_number} - {course_title}")
+DAYS_PATTERN = re.compile(r"..")
+SEAT_COUNT_PATTERN = re.compile(r"\d+")
+TERM_PATTERN = re.compile(r"2\d\d[147]")
+
+# Whitespace-only text nodes are filtered out by libxml2 rather than in Python
+NON_BLANK_TEXT = etree.XPath(".//text()[normalize-space()]", smart_strings=False)
+
+# Classes of the divs holding a course heading and a section on class search pages
+LISTING_KINDS = ("secondary-head", "section-content")
+
+
+class NoClassesFound(ValueError):
+    """Raised when a class search finds no classes matching its criteria."""
+
+
+# Marker in a class search page -> (error raised, its message)
+SEARCH_ERRORS = {
+    b"No classes found matching your criteria": (
+        NoClassesFound,
+        "Criteria didn't find any classes",
+    ),
+    b"The search took too long to respond, please try selecting additional search criteria.": (
+        ValueError,
+        "Search response took too long.",
+    ),
+}
+
+# Fields drawn from a small fixed vocabulary are interned so every section shares one string
+SECTION_INTERNED_FIELD = ("section_type", "session", "status")
 
 SECTION_DETAIL_INT_FIELD = {
     "seats_taken",
@@ -123,9 +183,28 @@ class Section(NamedTuple):
     instructor: str
     room: str
     status: str
-    meetings_dates: Optional[List[Tuple[datetime, datetime]]] = None
-    days: Optional[List[str]] = None
-    times: Optional[List[str]] = None
+    meeting_dates_raw: Optional[str] = None
+    days: Optional[List[Optional[List[str]]]] = None
+    times: Optional[List[Optional[Tuple[str, str]]]] = None
+
+    @property
+    def meetings_dates(self) -> Optional[Tuple[Tuple[datetime, datetime], ...]]:
+        """The meeting dates as datetimes, only parsed once they are asked for."""
+        if self.meeting_dates_raw is None:
+            return None
+        return _parse_meeting_dates(self.meeting_dates_raw)
+
+    def to_dict(self, raw_dates: bool = False) -> Dict[str, Any]:
+        """Returns the section as a JSON-ready dict, with meeting dates as ISO strings unless raw_dates is set."""
+        section = self._asdict()
+        meetings_dates = self.meetings_dates
+        if meetings_dates is not None and not raw_dates:
+            meetings_dates = [
+                (start.date().isoformat(), end.date().isoformat())
+                for start, end in meetings_dates
+            ]
+        section["meetings_dates"] = meetings_dates
+        return section
 
 
 class Course(NamedTuple):
@@ -140,6 +219,17 @@ class Subject(NamedTuple):
     courses: Dict[str, Course]
     term: Optional[str] = None
 
+    def to_arrays(self) -> Dict[str, List[Any]]:
+        """Flattens every section of the subject into one list per field, in course order."""
+        fields = ("subject_code", "course_number", "course_title") + Section._fields
+        rows = [
+            (course.subject_code, course.course_number, course.course_title, *section)
+            for course in self.courses.values()
+            for section in course.sections or ()
+        ]
+        columns = list(zip(*rows)) or [()] * len(fields)
+        return {field: list(column) for field, column in zip(fields, columns)}
+
 
 def _get_subject_json() -> Generator[Dict, None, None]:
     text = requests.get(CLASS_SEARCH_URL).text
@@ -175,75 +265,258 @@ def get_detailed_subject_codes() -> List[SubjectCode]:
     return subjects
 
 
-def _parse_class_search_page(resp: HTMLResponse, term: str) -> Dict:
-    if resp.html.search("No classes found matching your criteria"):
-        raise ValueError("Criteria didn't find any classes")
-    if resp.html.search(
-        "The search took too long to respond, please try selecting additional search criteria."
-    ):
-        raise ValueError("Search response took too long.")
-    if resp.status_code != 200:
-        raise ValueError()
-
-    courses = {}
-    elements = resp.html.find("div")
-
-    course: Optional[Course] = None
-    for element in elements:
-        print(element.text)
-        if "secondary-head" in element.attrs["class"]:
-            content = COURSE_INFORMATION_PATTERN.parse(element.text).named
-            course = Course(**content, sections=list())
-            courses[content["course_number"]] = course
-        elif "section-content" in element.attrs["class"]:
-            content = SECTION_INFORMATION_PATTERN.parse(element.text).named
-            del content["dt"]
-            del content["meeting_dates"]
-            section = Section(**content, term=term)
-            print(section)
-            course.sections.append(section)
-    return courses
+def _response_encoding(resp: requests.Response) -> str:
+    """Returns the charset the response declares, or UTF-8 instead of the Latin-1 requests assumes for HTML."""
+    if "charset" in resp.headers.get("Content-Type", "").lower() and resp.encoding:
+        return resp.encoding
+    return "utf-8"
+
+
+def _element_text(element: etree._Element) -> str:
+    """Returns the text of an element, one line per non-blank text node with whitespace squashed."""
+    return "\n".join([" ".join(text.split()) for text in NON_BLANK_TEXT(element)])
+
+
+def _parse_date(date: str) -> datetime:
+    """Parses a MM/DD/YYYY date by slicing, falling back to strptime if it isn't zero-padded."""
+    if len(date) == 10 and date[2] == "/" and date[5] == "/":
+        return datetime(int(date[6:10]), int(date[0:2]), int(date[3:5]))
+    return datetime.strptime(date, "%m/%d/%Y")
+
+
+# Sections in a term share a handful of date ranges, so parsed ranges are cached and shared
+@lru_cache(maxsize=256)
+def _parse_meeting_dates(
+    meeting_dates: str,
+) -> Optional[Tuple[Tuple[datetime, datetime], ...]]:
+    """Parses comma separated "MM/DD/YYYY - MM/DD/YYYY" meeting dates into one (start, end) per meeting."""
+    ranges = []
+    for meeting in meeting_dates.split(", "):
+        start, separator, end = meeting.partition(" - ")
+        if separator:
+            ranges.append((_parse_date(start), _parse_date(end)))
+    return tuple(ranges) or None
+
+
+def _parse_meeting_time(
+    meeting: str,
+) -> Tuple[Optional[List[str]], Optional[Tuple[str, str]]]:
+    """Splits a "MoWe 11:00am - 12:15pm" meeting into (["Mo", "We"], ("11:00am", "12:15pm"))."""
+    days, separator, times = meeting.partition(" ")
+    if not separator:
+        return None, None
+    start, separator, end = times.partition(" - ")
+    return DAYS_PATTERN.findall(days), (start, end) if separator else None
+
+
+def _parse_days_times(
+    days_times: str,
+) -> Tuple[
+    Optional[List[Optional[List[str]]]], Optional[List[Optional[Tuple[str, str]]]]
+]:
+    """Splits a section's comma separated meeting times into per-meeting days and times, lined up with
+    its meeting dates, returning (None, None) if no meeting has a time."""
+    meetings = [_parse_meeting_time(meeting) for meeting in days_times.split(", ")]
+    if all(days is None for days, _ in meetings):
+        return None, None
+    days, times = zip(*meetings)
+    return list(days), list(times)
+
+
+def _check_search_errors(content: bytes) -> None:
+    """Raises ValueError, or NoClassesFound, if content contains one of the class search error messages."""
+    for marker, (error, message) in SEARCH_ERRORS.items():
+        if marker in content:
+            raise error(message)
+
+
+def _iter_listing(resp: requests.Response) -> Generator[Tuple[str, str], None, None]:
+    """Yields (kind, text) for each listing div of a class search page while its body downloads."""
+    parser = etree.HTMLPullParser(tag="div", encoding=_response_encoding(resp))
+    # Keep the end of the previous chunk so error messages split across chunks are still found
+    overlap = max(len(marker) for marker in SEARCH_ERRORS) - 1
+    tail = b""
+    for chunk in resp.iter_content(chunk_size=LISTING_CHUNK_SIZE):
+        window = tail + chunk
+        _check_search_errors(window)
+        tail = window[-overlap:]
+        parser.feed(chunk)
+        yield from _read_listing(parser)
+    parser.close()
+    yield from _read_listing(parser)
+
+
+def _read_listing(
+    parser: etree.HTMLPullParser,
+) -> Generator[Tuple[str, str], None, None]:
+    """Yields (kind, text) for the listing divs the parser has finished, dropping each after."""
+    for _, element in parser.read_events():
+        classes = element.get("class", "").split()
+        for kind in LISTING_KINDS:
+            if kind in classes:
+                yield kind, _element_text(element)
+                element.clear()
+                _drop_parsed(element)
+                break
+
+
+def _drop_parsed(element: etree._Element) -> None:
+    """Removes everything before element and its ancestors, so the tree only holds the unread part of the page."""
+    node = element
+    while node.getparent() is not None:
+        parent = node.getparent()
+        while node.getprevious() is not None:
+            del parent[0]
+        node = parent
+
+
+def _parse_course(text: str) -> Course:
+    content = COURSE_INFORMATION_PATTERN.fullmatch(text).groupdict()
+    content["subject_code"] = sys.intern(content["subject_code"])
+    return Course(**content, sections=list())
+
+
+def _parse_section(text: str, term: str) -> Section:
+    content = SECTION_INFORMATION_PATTERN.fullmatch(text).groupdict()
+    for field in SECTION_INTERNED_FIELD:
+        content[field] = sys.intern(content[field])
+    content["days"], content["times"] = _parse_days_times(content.pop("dt"))
+    return Section(**content, term=term)
+
+
+def _parse_class_search_page(resp: requests.Response, term: str) -> Dict:
+    """Parses a streamed class search response, closing it even if parsing stops partway."""
+    try:
+        if resp.status_code != 200:
+            _check_search_errors(resp.content)
+            raise ValueError()
+
+        courses = {}
+        course: Optional[Course] = None
+        for kind, text in _iter_listing(resp):
+            if kind == "secondary-head":
+                course = _parse_course(text)
+                courses[course.course_number] = course
+            else:
+                course.sections.append(_parse_section(text, term))
+        return courses
+    finally:
+        resp.close()
 
 
 def get_extra_section_details(
-    *, section: Section = None, term=None, class_number=None
+    *, section: Section = None, term=None, class_number=None, refresh: bool = False
 ) -> SectionDetails:
+    """Returns a section's extra details.
+
+    Details are cached for SECTION_DETAIL_LIFETIME seconds since they include live seat counts.
+    Pass refresh=True to fetch them again regardless.
+    """
     if section is None and (term is None or class_number is None):
         raise ValueError()
     if section is not None:
         term = section.term
         class_number = section.class_number
+    term, class_number = str(term), str(class_number)
+    cached = _SECTION_DETAILS.get((term, class_number))
+    if (
+        refresh
+        or cached is None
+        or time.monotonic() - cached[0] > SECTION_DETAIL_LIFETIME
+    ):
+        return _fetch_section_details(term, class_number)
+    _SECTION_DETAILS.move_to_end((term, class_number))
+    return cached[1]
 
-    data = {"term": term}
-    session = HTMLSession()
 
+def _fetch_section_details(term: str, class_number: str) -> SectionDetails:
     url = SECTION_DETAIL_URL.format(term=term, class_number=class_number)
-    resp = session.get(url)
-    elements = resp.html.xpath("/html/body/section/section/div")
+    resp = _SESSION.get(url)
+    return _cache_section_details(
+        term, class_number, _parse_section_details(resp, term)
+    )
+
+
+def _cache_section_details(
+    term: str, class_number: str, details: SectionDetails
+) -> SectionDetails:
+    """Stores freshly fetched details, dropping the least recently used once SECTION_DETAIL_CACHE_SIZE is reached."""
+    _SECTION_DETAILS[term, class_number] = (time.monotonic(), details)
+    _SECTION_DETAILS.move_to_end((term, class_number))
+    if len(_SECTION_DETAILS) > SECTION_DETAIL_CACHE_SIZE:
+        _SECTION_DETAILS.popitem(last=False)
+    return details
+
+
+def get_extra_section_details_bulk(sections: List[Section]) -> List[SectionDetails]:
+    """Fetches the extra details of many sections concurrently, in the order given.
+
+    Unlike get_extra_section_details, every section is fetched fresh. The results replace any
+    cached details. A section whose request fails is fetched again on its own.
+    """
+    # Imported here since grequests monkey-patches the standard library through gevent
+    import grequests
+
+    responses = grequests.map(
+        [
+            grequests.get(
+                SECTION_DETAIL_URL.format(
+                    term=section.term, class_number=section.class_number
+                ),
+                session=_SESSION,
+            )
+            for section in sections
+        ],
+        size=BULK_REQUEST_LIMIT,
+    )
+    details = []
+    for section, resp in zip(sections, responses):
+        if resp is None:
+            # grequests.map gives None for a request that failed to send, so retry it on its own
+            details.append(_fetch_section_details(section.term, section.class_number))
+        else:
+            details.append(
+                _cache_section_details(
+                    section.term,
+                    section.class_number,
+                    _parse_section_details(resp, section.term),
+                )
+            )
+    return details
+
+
+def _parse_section_details(resp: requests.Response, term: str) -> SectionDetails:
+    data = {"term": term}
+    # The pages don't declare a charset, so without one libxml2 would decode the bytes as Latin-1
+    parser = lxml.html.HTMLParser(encoding=_response_encoding(resp))
+    root = lxml.html.fromstring(resp.content, parser=parser)
+    elements = root.xpath("/html/body/section/section/div")
     heading = ""
     for element in elements:
-        print(element.text, end="\n\n")
-        if "role" in element.attrs:
-            heading = element.text
+        text = _element_text(element)
+        if "role" in element.attrib:
+            heading = text
             continue
 
         if heading == "Combined Section":
             if "combined_sections" not in data:
                 data["combined_sections"] = []
-            content = COMBINED_SECTION_PATTERN.parse(element.text)
+            content = COMBINED_SECTION_PATTERN.parse(text)
             combined_section = CombinedSection(**content.named, term=term)
             data["combined_sections"].append(combined_section)
             continue
 
-        if "\n" not in element.text:
+        if "\n" not in text:
             continue
 
-        label, content, *extra = element.text.split("\n")
+        label, content, *extra = text.split("\n")
 
         if heading == "Enrollment Restrictions":
             if "seat_restrictions" not in data:
                 data["seat_restrictions"] = {}
-            data["seat_restrictions"][label] = int(re.search("\d+", content).group())
+            data["seat_restrictions"][label] = int(
+                SEAT_COUNT_PATTERN.search(content).group()
+            )
             continue
 
         if label in LABEL_MAP:
@@ -263,37 +536,56 @@ def get_extra_section_details(
 
 def _validate_term(term: str) -> str:
     """Validates that the term entered follows the pattern that Pitt does for term codes."""
-    valid_terms = re.compile("2\d\d[147]")
-    if valid_terms.match(term):
+    if TERM_PATTERN.match(term):
         return term
     raise ValueError("Term entered isn't a valid Pitt term.")
 
 
 def _validate_course(course: str) -> str:
     """Validates that the course name entered is 4 characters long and in string form."""
-    if course == "":
-        raise ValueError("Invalid course number.")
-    if not course.isdigit():
-        raise ValueError("Invalid course number.")
-    course_length = len(course)
-    if course_length < 4:
-        return ("0" * (4 - course_length)) + course
-    elif course_length > 4:
+    if isinstance(course, int):
+        if course <= 0:
+            raise ValueError("Invalid course number.")
+        course = str(course)
+    if not course.isdigit() or len(course) > 4:
         raise ValueError("Invalid course number.")
-    return course
+    return course.zfill(4)
 
 
-def _get_payload(
-    term, *, subject="", course="", section=""
-) -> Tuple[HTMLSession, Dict[str, str]]:
-    """Make payload for request and generates CSRFToken for the request"""
+_SESSION = requests.Session()
+_SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=BULK_REQUEST_LIMIT, pool_maxsize=2 * BULK_REQUEST_LIMIT
+    ),
+)
+_CSRF = {"token": None, "timestamp": 0.0}
+# (term, class_number) -> (timestamp, SectionDetails), least recently used first
+_SECTION_DETAILS: "OrderedDict[Tuple[str, str], Tuple[float, SectionDetails]]" = (
+    OrderedDict()
+)
+
+
+def _get_csrf_token(*, refresh: bool = False) -> str:
+    """Returns the shared session's CSRFToken, generating a new one if it is missing or stale."""
+    now = time.monotonic()
+    if (
+        refresh
+        or _CSRF["token"] is None
+        or now - _CSRF["timestamp"] > CSRF_TOKEN_LIFETIME
+    ):
+        _SESSION.get(CLASS_SEARCH_URL)
+        _CSRF["token"] = _SESSION.cookies["CSRFCookie"]
+        _CSRF["timestamp"] = now
+    return _CSRF["token"]
 
-    # Generate new CSRFToken
-    session = HTMLSession()
-    session.get(CLASS_SEARCH_URL)
 
+def _get_payload(
+    term, *, subject="", course="", section="", refresh_token=False
+) -> Tuple[requests.Session, Dict[str, str]]:
+    """Make payload for request using the shared session's CSRFToken"""
     payload = {
-        "CSRFToken": session.cookies["CSRFCookie"],
+        "CSRFToken": _get_csrf_token(refresh=refresh_token),
         "term": term,
         "campus": "PIT",
         "subject": subject,
@@ -301,26 +593,76 @@ def _get_payload(
         "catalog_nbr": course,
         "class_nbr": section,
     }
-    return session, payload
+    return _SESSION, payload
+
+
+def _post_class_search(term, **criteria) -> requests.Response:
+    """Posts a class search, retrying once with a new CSRFToken if the cached one was rejected."""
+    # Streamed so the body can be parsed while it is still downloading
+    session, payload = _get_payload(term, **criteria)
+    response = session.post(CLASS_SEARCH_API_URL, data=payload, stream=True)
+    if response.status_code in CSRF_REJECTED_STATUS:
+        response.close()
+        session, payload = _get_payload(term, refresh_token=True, **criteria)
+        response = session.post(CLASS_SEARCH_API_URL, data=payload, stream=True)
+    return response
+
+
+def _search_courses(term: str, **criteria) -> Dict[str, Course]:
+    """Runs a class search and returns the courses it found keyed by course number."""
+    response = _post_class_search(term, **criteria)
+    return _parse_class_search_page(response, term)
 
 
 def get_courses(term: str, subject: str) -> Subject:
     """Returns a list of courses available in term for a particular subject."""
     term = _validate_term(term)
-    session, payload = _get_payload(term, subject=subject)
-    response = session.post(CLASS_SEARCH_API_URL, data=payload)
-    courses = _parse_class_search_page(response, term)
+    courses = _search_courses(term, subject=subject)
     subject = Subject(subject_code=subject, term=term, courses=courses)
     return subject
 
 
+def get_courses_bulk(term: str, subjects: List[str]) -> Dict[str, Subject]:
+    """Returns the courses available in term for each of several subjects, fetched concurrently.
+
+    A subject with no classes in term gets a Subject with no courses. Any other search error is raised.
+    """
+    term = _validate_term(term)
+    # Imported here since grequests monkey-patches the standard library through gevent
+    import grequests
+
+    responses = grequests.map(
+        [
+            grequests.post(
+                CLASS_SEARCH_API_URL,
+                data=_get_payload(term, subject=subject)[-1],
+                session=_SESSION,
+            )
+            for subject in subjects
+        ],
+        size=BULK_REQUEST_LIMIT,
+    )
+    subjects_by_code = {}
+    for subject, response in zip(subjects, responses):
+        try:
+            if response is None or response.status_code in CSRF_REJECTED_STATUS:
+                courses = _search_courses(term, subject=subject)
+            else:
+                courses = _parse_class_search_page(response, term)
+        except NoClassesFound:
+            # One subject with no classes this term shouldn't lose the rest of the batch
+            courses = {}
+        subjects_by_code[subject] = Subject(
+            subject_code=subject, term=term, courses=courses
+        )
+    return subjects_by_code
+
+
 def get_course_sections(term: str, subject: str, course: str) -> Section:
     """Return details on all sections taught in a certain course"""
     term = _validate_term(term)
     course = _validate_course(course)
-    session, payload = _get_payload(term, subject=subject, course=course)
-    response = session.post(CLASS_SEARCH_API_URL, data=payload)
-    course, *_ = _parse_class_search_page(response, term).values()
+    course, *_ = _search_courses(term, subject=subject, course=course).values()
     return course
 
 
@@ -329,7 +671,5 @@ def get_section_details(term: str, section_number: str) -> Course:
     term = _validate_term(term)
     if isinstance(section_number, int):
         section_number = str(section_number)
-    session, payload = _get_payload(term, section=section_number)
-    response = session.post(CLASS_SEARCH_API_URL, data=payload)
-    course, *_ = _parse_class_search_page(response, term).values()
+    course, *_ = _search_courses(term, section=section_number).values()
     return course
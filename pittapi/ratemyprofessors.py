@@ -71,8 +71,8 @@ def _rename_result_fields(result: Dict[str, Any]) -> Dict[str, Any]:
     if result_field in FIELD_TO_NAME_MAPPING:
       renamed_result[FIELD_TO_NAME_MAPPING[result_field]] = result[result_field]
     else:
-      raise ValueError(("Attempted to rename internal name '{}' but no mapping exists. This likely"
-        + " means that the structure of RMP data has changed.").format(result_field))
+      raise ValueError(f"Attempted to rename internal name '{result_field}' but no mapping exists. This likely"
+        + " means that the structure of RMP data has changed.")
 
   return renamed_result
 
@@ -83,9 +83,9 @@ def _rename_response_fields(response_fields: List[str]) -> List[str]:
     if response_field in NAME_TO_FIELD_MAPPING:
       renamed_result.append(NAME_TO_FIELD_MAPPING[response_field])
     else:
-      raise ValueError(("Attempted to rename response field '{}' to internal RMP naming but no"
+      raise ValueError(f"Attempted to rename response field '{response_field}' to internal RMP naming but no"
         + " mapping exists. This likely means that you have"
-        + " inputted an invalid response field name.").format(response_field))
+        + " inputted an invalid response field name.")
   
   return renamed_result
 
@@ -117,7 +117,7 @@ def get_rmp_by_name(
   query.
   """
   return get_rmp_by_query(
-    query="{prof_name} AND schoolid_s:{school_id}".format(prof_name=prof_name, school_id=school_id),
+    query=f"{prof_name} AND schoolid_s:{school_id}",
     additional_request_params={
       "defType": "edismax", # https://lucene.apache.org/solr/guide/6_6/the-extended-dismax-query-parser.html#TheExtendedDisMaxQueryParser-ThesowParameter
       "qf": "teacherfirstname_t^2000 teacherlastname_t^2000 teacherfullname_t^2000 autosuggest", # https://lucene.apache.org/solr/guide/6_6/the-dismax-query-parser.html#TheDisMaxQueryParser-Theqf_QueryFields_Parameter
@@ -141,11 +141,7 @@ def get_rmp_by_name_fuzzy(
   https://lucene.apache.org/solr/guide/6_6/the-standard-query-parser.html#TheStandardQueryParser-FuzzySearches
   """
   return get_rmp_by_query(
-    query= ("{prof_first_name}~ {prof_last_name}~ AND schoolid_s:{school_id}").format(
-        prof_first_name=prof_first_name,
-        prof_last_name=prof_last_name,
-        school_id=school_id
-      ),
+    query=f"{prof_first_name}~ {prof_last_name}~ AND schoolid_s:{school_id}",
     additional_request_params={
       "defType": "edismax", # https://lucene.apache.org/solr/guide/6_6/the-extended-dismax-query-parser.html#TheExtendedDisMaxQueryParser-ThesowParameter
       "qf": "teacherfirstname_t^2000 teacherlastname_t^2000 teacherfullname_t^2000 autosuggest", # https://lucene.apache.org/solr/guide/6_6/the-dismax-query-parser.html#TheDisMaxQueryParser-Theqf_QueryFields_Parameter
@@ -163,7 +159,7 @@ def get_rmp_by_id(
 ) -> Union[Dict[str, Any], None]:
   """Query RMP with the professor's RMP ID."""
   query_results = get_rmp_by_query(
-    query="pk_id:{prof_id}".format(prof_id=prof_id),
+    query=f"pk_id:{prof_id}",
     additional_request_params={
       "fl": " ".join(_rename_response_fields(response_fields)), # https://lucene.apache.org/solr/guide/6_6/common-query-parameters.html#CommonQueryParameters-Thefl_FieldList_Parameter,
     }
@@ -214,6 +214,8 @@ CODES = [
     "URBNST",
     "VIET",
 ]
+# Position of each code in CODES, so department lookups don't scan the list
+CODE_INDEXES = {code: index for index, code in enumerate(CODES)}
 KEYS = ["isbn", "citation", "title", "edition", "author"]
 QUERIES = {
     "courses": "compare/courses/?id={}&term_id={}",
@@ -247,9 +249,7 @@ def _validate_course(course: str) -> str:
      """
     if len(course) > 4 or not course.isdigit():
         raise ValueError("Invalid course number")
-    elif len(course) == 4:
-        return course
-    return "0" * (4 - len(course)) + course
+    return course.zfill(4)
 
 
 def _filter_dictionary(d: Dict[Any, Any], keys: List[Any]) -> Dict[Any, Any]:
@@ -268,7 +268,7 @@ def _find_item(id_key, data_key, error_item) -> Callable[[Dict[Any, Any], Any],
         for item in data:
             if item[id_key] == value:
                 return item[data_key]
-        raise LookupError("Can't find {} {}.".format(error_item, str(value)))
+        raise LookupError(f"Can't find {error_item} {value}.")
 
     return find
 
@@ -320,6 +320,8 @@ def _extract_books(ids: List[str]) -> List[Dict[str, str]]:
 # Meant to force a return of None instead of raising a KeyError
 # when using a nonexistent key
 class DefaultDict(dict):
+    __slots__ = ()
+
     def __missing__(self, key):
         return None
 
@@ -343,7 +345,9 @@ def _get_department_number(department_code: str) -> int:
     There will be a new method to getting department information
     at a later time.
     """
-    department_number = CODES.index(department_code) + 22399
+    if department_code not in CODE_INDEXES:
+        raise ValueError("Invalid department code")
+    department_number = CODE_INDEXES[department_code] + 22399
     if department_number > 22462:
         department_number += 2  # between codes DSANE and EAS 2 id numbers are skipped.
     if department_number > 22580:
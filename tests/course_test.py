@@ -18,8 +18,12 @@ with this program; if not, write to the Free Software Foundation, Inc.,
 """
 
 import json
+import subprocess
+import sys
 import unittest
+import lxml.html
 import responses
+from datetime import datetime
 from unittest.mock import patch
 
 from pathlib import Path
@@ -28,12 +32,45 @@ from pittapi import course
 
 SAMPLE_PATH = Path.cwd() / 'tests' / 'samples'
 
+LISTING_HTML = b"""<div class="primary-head"></div>
+<div class="secondary-head class-title-header">CS 1632 - SOFTWARE QUALITY ASSURANCE</div>
+<a href="https://psmobile.pitt.edu/app/catalog/classsection/UPITT/2194/27469">
+    <div class="section-content">
+        <div class="strong section-body">Section: 1120-LEC (27469)</div>
+        <div class="section-body">Session: Academic Term</div>
+        <div class="section-body">Days/Times: MoWe 3:00pm - 4:15pm</div>
+        <div class="section-body">Room: 203 Lawrence Hall</div>
+        <div class="section-body">Instructor: William Laboon</div>
+        <div class="section-body">Meeting Dates: 01/07/2019 - 04/19/2019</div>
+        <div class="section-body">Status: Open</div>
+    </div>
+</a>"""
+NO_CLASSES_HTML = b'<div class="alert">No classes found matching your criteria</div>'
+
 
 class RequestText:
     def __init__(self, text):
         self.text = text
 
 
+class StreamedResponse:
+    def __init__(self, content, chunk_size=None, status_code=200):
+        self.content = content
+        self.headers = {}
+        self.encoding = None
+        self.chunk_size = chunk_size
+        self.status_code = status_code
+        self.closed = False
+
+    def iter_content(self, chunk_size=1):
+        chunk_size = self.chunk_size or chunk_size
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i:i + chunk_size]
+
+    def close(self):
+        self.closed = True
+
+
 class MockSession:
 
     def __init__(self, text=None):
@@ -64,6 +101,13 @@ class CourseTest(unittest.TestCase):
             self.cs_extra_data_3 = ''.join(f.readlines())
         with (SAMPLE_PATH / 'course_extra_4.html').open() as f:
             self.cs_extra_data_4 = ''.join(f.readlines())
+        self.cs_section = course.Section(term='2194', session='Academic Term', section_number='1120',
+                                         class_number='27469', section_type='LEC', instructor='William Laboon',
+                                         room='203 Lawrence Hall', status='Open',
+                                         meeting_dates_raw='01/07/2019 - 04/19/2019')
+
+    def setUp(self):
+        course._SECTION_DETAILS.clear()
 
     def test_validate_subject(self):
         for subject in course.SUBJECTS:
@@ -98,16 +142,138 @@ class CourseTest(unittest.TestCase):
         self.assertRaises(ValueError, course._validate_course, 'Hello')
         self.assertRaises(ValueError, course._validate_course, '10000')
 
+    def test_parse_meeting_dates(self):
+        self.assertEqual(course._parse_date('01/07/2019'), datetime(2019, 1, 7))
+        self.assertEqual(course._parse_meeting_dates('01/07/2019 - 04/19/2019'),
+                         ((datetime(2019, 1, 7), datetime(2019, 4, 19)),))
+        self.assertIsNone(course._parse_meeting_dates('TBA'))
+
+    def test_parse_meeting_dates_multiple_meetings(self):
+        self.assertEqual(course._parse_meeting_dates('01/07/2019 - 04/19/2019, 01/07/2019 - 02/22/2019'),
+                         ((datetime(2019, 1, 7), datetime(2019, 4, 19)), (datetime(2019, 1, 7), datetime(2019, 2, 22))))
+        self.assertEqual(course._parse_meeting_dates('1/7/2019 - 4/19/2019'),
+                         ((datetime(2019, 1, 7), datetime(2019, 4, 19)),))
+        self.assertRaises(ValueError, course._parse_date, '2019-01-07')
+
+    def test_section_meetings_dates(self):
+        section = self.cs_section
+        self.assertEqual(section.meetings_dates, ((datetime(2019, 1, 7), datetime(2019, 4, 19)),))
+        self.assertIsNone(section._replace(meeting_dates_raw=None).meetings_dates)
+
+    def test_section_to_dict(self):
+        section = self.cs_section
+        self.assertEqual(section.to_dict()['meetings_dates'], [('2019-01-07', '2019-04-19')])
+        self.assertIsInstance(json.dumps(section.to_dict()), str)
+        self.assertEqual(section.to_dict(raw_dates=True)['meetings_dates'], section.meetings_dates)
+        self.assertIsNone(section._replace(meeting_dates_raw=None).to_dict()['meetings_dates'])
+        self.assertEqual(section.to_dict()['meeting_dates_raw'], '01/07/2019 - 04/19/2019')
+
+    def test_parse_days_times(self):
+        self.assertEqual(course._parse_days_times('MoWeFr 9:00am - 9:50am'),
+                         ([['Mo', 'We', 'Fr']], [('9:00am', '9:50am')]))
+        self.assertEqual(course._parse_days_times('Th 6:00pm - 8:30pm'), ([['Th']], [('6:00pm', '8:30pm')]))
+        self.assertEqual(course._parse_days_times('TBA'), (None, None))
+
+    def test_parse_days_times_multiple_meetings(self):
+        self.assertEqual(course._parse_days_times('Fr 9:00am - 9:50am, Fr 9:00am - 9:50am, Fr 9:00am - 9:50am'),
+                         ([['Fr']] * 3, [('9:00am', '9:50am')] * 3))
+        self.assertEqual(course._parse_days_times('TBA, TuTh 1:00pm - 2:15pm'),
+                         ([None, ['Tu', 'Th']], [None, ('1:00pm', '2:15pm')]))
+
+    def test_subject_to_arrays(self):
+        sections = [
+            self.cs_section._replace(section_number=section_number, class_number=class_number)
+            for section_number, class_number in [('1120', '27469'), ('1130', '27470')]
+        ]
+        cs_course = course.Course(subject_code='CS', course_number='1632', course_title='SOFTWARE QUALITY ASSURANCE',
+                                  sections=sections)
+        cs_subject = course.Subject(subject_code='CS', term='2194', courses={'1632': cs_course})
+        arrays = cs_subject.to_arrays()
+        self.assertEqual(arrays['course_number'], ['1632', '1632'])
+        self.assertEqual(arrays['class_number'], ['27469', '27470'])
+        self.assertEqual(arrays['days'], [None, None])
+        self.assertEqual(arrays['meeting_dates_raw'], ['01/07/2019 - 04/19/2019'] * 2)
+        self.assertEqual(course.Subject(subject_code='CS', courses={}).to_arrays()['class_number'], [])
+
+    def test_parse_class_search_page_streamed(self):
+        resp = StreamedResponse(b'<html><body>' + LISTING_HTML + b'</body></html>', chunk_size=7)
+        courses = course._parse_class_search_page(resp, '2194')
+        self.assertTrue(resp.closed)
+        self.assertEqual(list(courses), ['1632'])
+        cs_course = courses['1632']
+        self.assertEqual(cs_course.course_title, 'SOFTWARE QUALITY ASSURANCE')
+        section, = cs_course.sections
+        self.assertEqual(section.class_number, '27469')
+        self.assertEqual(section.instructor, 'William Laboon')
+        self.assertEqual(section.days, [['Mo', 'We']])
+
+    def test_parse_class_search_page_subject_sample(self):
+        courses = course._parse_class_search_page(StreamedResponse(self.cs_subject_data.encode()), '2194')
+        self.assertEqual({number: len(c.sections) for number, c in courses.items()}, {'0004': 2, '0007': 12})
+        section = courses['0004'].sections[0]
+        self.assertEqual(courses['0004'].course_title, 'INTRODUCTION TO COMPUTER PROGRAMMING-BASIC')
+        self.assertEqual(section.class_number, '27865')
+        self.assertEqual(section.instructor, 'Michael Devine')
+        self.assertEqual(section.status, 'Wait')
+        self.assertEqual(section.days, [['Mo', 'We']])
+        self.assertEqual(section.times, [('9:30am', '10:45am')])
+        self.assertEqual(section.meetings_dates, ((datetime(2019, 1, 7), datetime(2019, 4, 19)),))
+
+    def test_parse_class_search_page_course_sample(self):
+        courses = course._parse_class_search_page(StreamedResponse(self.cs_course_data.encode()), '2194')
+        self.assertEqual(list(courses), ['0007'])
+        sections = {section.class_number: section for section in courses['0007'].sections}
+        self.assertEqual(len(sections), 12)
+        section = sections['27875']
+        self.assertEqual(section.status, 'Open')
+        self.assertEqual(section.days, [['Fr']] * 3)
+        self.assertEqual(section.times, [('9:00am', '9:50am')] * 3)
+        self.assertEqual(section.meetings_dates, ((datetime(2019, 1, 7), datetime(2019, 4, 19)),) * 3)
+
+    def test_parse_class_search_page_streamed_non_ascii(self):
+        content = LISTING_HTML.replace(b'William Laboon', 'José Núñez'.encode())
+        courses = course._parse_class_search_page(StreamedResponse(content, chunk_size=7), '2194')
+        self.assertEqual(courses['1632'].sections[0].instructor, 'José Núñez')
+
+    def test_drop_parsed(self):
+        root = lxml.html.fromstring('<div><div class="primary-head"></div><a><div id="1"></div></a>'
+                                    '<a><div id="2"></div></a><a><div id="3"></div></a></div>')
+        element, = root.xpath('//div[@id="2"]')
+        course._drop_parsed(element)
+        self.assertEqual(len(root), 2)
+        self.assertIs(root[0][0], element)
+        self.assertEqual(root[1][0].get('id'), '3')
+
+    def test_parse_class_search_page_streamed_no_classes(self):
+        content = LISTING_HTML + NO_CLASSES_HTML
+        # Split the message across chunks so it is only found by checking the previous chunk's tail too
+        split = content.index(b'No classes found') + len(b'No classes')
+        for chunk_size in (split, 5):
+            resp = StreamedResponse(content, chunk_size=chunk_size)
+            self.assertRaises(course.NoClassesFound, course._parse_class_search_page, resp, '2194')
+            self.assertTrue(resp.closed)
+
+    def test_parse_class_search_page_error_status(self):
+        resp = StreamedResponse(NO_CLASSES_HTML, status_code=500)
+        self.assertRaises(ValueError, course._parse_class_search_page, resp, '2194')
+        self.assertTrue(resp.closed)
+
     def test_get_payload(self):
         TRUE_PAYLOAD = {'CSRFToken': 'abc', 'term': '2194', 'campus': 'PIT', 'subject': 'CS', 'acad_career': '',
                         'catalog_nbr': '1501', 'class_nbr': '27740'}
-        with patch('requests.Session') as mock:
-            mock.return_value = MockSession()
-
+        with patch.object(course, '_SESSION', MockSession()), patch.dict(course._CSRF, token=None):
             payload = course._get_payload('2194', subject='CS', course='1501', section='27740')[-1]
             for k, v in payload.items():
                 self.assertEqual(v, TRUE_PAYLOAD[k])
 
+    def test_get_payload_reuses_csrf_token(self):
+        session = MockSession()
+        with patch.object(course, '_SESSION', session), patch.dict(course._CSRF, token=None):
+            course._get_payload('2194', subject='CS')
+            session.cookies = {'CSRFCookie': 'def'}
+            self.assertEqual(course._get_payload('2194', subject='CS')[-1]['CSRFToken'], 'abc')
+            self.assertEqual(course._get_payload('2194', subject='CS', refresh_token=True)[-1]['CSRFToken'], 'def')
+
     def test_get_term_courses(self):
         with patch('requests.Session') as mock:
             mock.return_value = MockSession(self.cs_subject_data)
@@ -193,6 +359,99 @@ class CourseTest(unittest.TestCase):
             self.assertIsInstance(cs_section.to_dict(), dict)
             self.assertIsInstance(cs_section.to_dict(extra_details=True), dict)
 
+    @responses.activate
+    def test_get_extra_section_details_cached(self):
+        responses.add(responses.GET, 'https://psmobile.pitt.edu/app/catalog/classsection/UPITT/2194/27469',
+                      body=self.cs_extra_data_2, status=200)
+        details = course.get_extra_section_details(term='2194', class_number=27469)
+        self.assertIs(course.get_extra_section_details(term='2194', class_number='27469'), details)
+        self.assertEqual(len(responses.calls), 1)
+
+    @responses.activate
+    def test_get_extra_section_details_non_ascii(self):
+        body = self.cs_extra_data_2.replace('This course provides', 'José Núñez’s course provides').encode()
+        responses.add(responses.GET, 'https://psmobile.pitt.edu/app/catalog/classsection/UPITT/2194/27469',
+                      body=body, status=200, content_type='text/html')
+        details = course.get_extra_section_details(term='2194', class_number='27469')
+        self.assertTrue(details.description.startswith('José Núñez’s course provides'))
+
+    @responses.activate
+    def test_get_extra_section_details_declared_charset(self):
+        body = self.cs_extra_data_2.replace('This course provides', 'José’s course provides').encode('cp1252')
+        responses.add(responses.GET, 'https://psmobile.pitt.edu/app/catalog/classsection/UPITT/2194/27469',
+                      body=body, status=200, content_type='text/html; charset=windows-1252')
+        details = course.get_extra_section_details(term='2194', class_number='27469')
+        self.assertTrue(details.description.startswith('José’s course provides'))
+
+    @responses.activate
+    def test_get_extra_section_details_evicts_least_recently_used(self):
+        for class_number in ['27469', '27470', '27471']:
+            url = 'https://psmobile.pitt.edu/app/catalog/classsection/UPITT/2194/' + class_number
+            responses.add(responses.GET, url, body=self.cs_extra_data_2, status=200)
+        with patch.object(course, 'SECTION_DETAIL_CACHE_SIZE', 2):
+            course.get_extra_section_details(term='2194', class_number='27469')
+            course.get_extra_section_details(term='2194', class_number='27470')
+            course.get_extra_section_details(term='2194', class_number='27469')
+            course.get_extra_section_details(term='2194', class_number='27471')
+        self.assertEqual(list(course._SECTION_DETAILS), [('2194', '27469'), ('2194', '27471')])
+        self.assertEqual(len(responses.calls), 3)
+
+    @responses.activate
+    def test_get_extra_section_details_refresh(self):
+        responses.add(responses.GET, 'https://psmobile.pitt.edu/app/catalog/classsection/UPITT/2194/27469',
+                      body=self.cs_extra_data_2, status=200)
+        details = course.get_extra_section_details(term='2194', class_number='27469')
+        self.assertIsNot(course.get_extra_section_details(term='2194', class_number='27469', refresh=True), details)
+        self.assertEqual(len(responses.calls), 2)
+        with patch.object(course, 'SECTION_DETAIL_LIFETIME', -1):
+            course.get_extra_section_details(term='2194', class_number='27469')
+        self.assertEqual(len(responses.calls), 3)
+
+    @responses.activate
+    def test_get_extra_section_details_bulk(self):
+        responses.add(responses.GET, 'https://psmobile.pitt.edu/app/catalog/classsection/UPITT/2194/27469',
+                      body=self.cs_extra_data_2, status=200)
+        responses.add(responses.GET, 'https://psmobile.pitt.edu/app/catalog/classsection/UPITT/2194/27470',
+                      body=self.cs_extra_data_3, status=200)
+        sections = [
+            self.cs_section._replace(class_number=class_number)
+            for class_number in ['27469', '27470']
+        ]
+        details = course.get_extra_section_details_bulk(sections)
+        self.assertEqual(len(details), 2)
+        self.assertTrue(details[0].preqs.startswith('PREQ: '))
+        self.assertEqual(details[1].preqs, '')
+
+    @responses.activate
+    def test_get_extra_section_details_bulk_failed_request(self):
+        responses.add(responses.GET, 'https://psmobile.pitt.edu/app/catalog/classsection/UPITT/2194/27469',
+                      body=self.cs_extra_data_2, status=200)
+        with patch('grequests.map', return_value=[None]):
+            details, = course.get_extra_section_details_bulk([self.cs_section])
+        self.assertTrue(details.preqs.startswith('PREQ: '))
+        self.assertEqual(len(responses.calls), 1)
+
+    def test_import_does_not_load_grequests(self):
+        # grequests monkey-patches the standard library on import, so only the bulk getters load it
+        code = 'import sys; from pittapi import course; sys.exit("grequests" in sys.modules)'
+        self.assertEqual(subprocess.run([sys.executable, '-c', code]).returncode, 0)
+
+    def test_get_courses_bulk(self):
+        search_responses = [StreamedResponse(LISTING_HTML), StreamedResponse(NO_CLASSES_HTML)]
+        with patch.object(course, '_SESSION', MockSession()), patch.dict(course._CSRF, token=None), \
+                patch('grequests.map', return_value=search_responses):
+            subjects = course.get_courses_bulk('2194', ['CS', 'ASL'])
+        self.assertEqual(list(subjects['CS'].courses), ['1632'])
+        self.assertEqual(subjects['CS'].courses['1632'].sections[0].class_number, '27469')
+        self.assertEqual(subjects['ASL'].courses, {})
+
+    def test_get_courses_bulk_search_error(self):
+        too_long = b'<div>The search took too long to respond, please try selecting additional search criteria.</div>'
+        search_responses = [StreamedResponse(too_long)]
+        with patch.object(course, '_SESSION', MockSession()), patch.dict(course._CSRF, token=None), \
+                patch('grequests.map', return_value=search_responses):
+            self.assertRaises(ValueError, course.get_courses_bulk, '2194', ['CS'])
+
     @responses.activate
     def test_get_section_details_extra_details(self):
         responses.add(responses.GET, 'https://psmobile.pitt.edu/app/catalog/classsection/UPITT/2194/27469',